@@ -1,12 +1,14 @@
 import os
+import asyncio
 import logging
 import asyncpg
 from html import escape
 import re
+from dataclasses import dataclass
 from telegram import Update
 from telegram.constants import ParseMode
-from telegram.error import BadRequest
-from telegram.ext import Application, MessageHandler, filters, ContextTypes
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.ext import AIORateLimiter, Application, MessageHandler, filters, ContextTypes
 
 # ================= CONFIG =================
 
@@ -22,8 +24,36 @@ LOG_CHAT_ID = int(os.environ.get("LOG_CHAT_ID", "0"))
 if not LOG_CHAT_ID:
     raise ValueError("LOG_CHAT_ID environment variable is missing.")
 
+# Pool sizing. The handler runs one update at a time, so a small pool is
+# plenty. PGBOUNCER=1 disables asyncpg's statement cache and drops the
+# synchronous_commit/jit session settings, neither of which transaction
+# pooling mode can support.
+PG_MIN_SIZE = int(os.environ.get("PG_MIN_SIZE", "1"))
+PG_MAX_SIZE = int(os.environ.get("PG_MAX_SIZE", "5"))
+PGBOUNCER = os.environ.get("PGBOUNCER", "").lower() in ("1", "true", "yes")
+
 db_pool = None
 
+@dataclass(slots=True)
+class TrackedMsgs:
+    """In-memory copy of one tracked_msgs row."""
+    poster_msg_id: int | None = None
+    candidate_id: int | None = None
+    candidate_text: str | None = None
+
+def tracked_from_row(row) -> TrackedMsgs:
+    """Build the cache entry from a tracked_msgs record, matching columns by name."""
+    return TrackedMsgs(
+        poster_msg_id=row["poster_msg_id"],
+        candidate_id=row["candidate_id"],
+        candidate_text=row["candidate_text"],
+    )
+
+# channel_id -> TrackedMsgs, or None when the channel has no row. This process
+# is the only writer of tracked_msgs, so the cache is written through after
+# every UPSERT/UPDATE and never goes stale.
+tracked_cache: dict[int, TrackedMsgs | None] = {}
+
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     level=logging.INFO
@@ -44,58 +74,151 @@ BLACKLIST_REGEX = re.compile(
     re.IGNORECASE
 )
 
+# Fingerprints extract_candidate_text stores for non-text spam
+SPAM_MARKERS = frozenset(("[APK_FILE]", "[AUDIO_SPAM]"))
+
 TOSS_REGEX = re.compile(r'toss winner', re.IGNORECASE)
 
+LINK_REGEX = re.compile(r'https?://|t\.me', re.IGNORECASE)
+
+# ================= MESSAGES =================
+
+TOSS_REPLY_TEXT = (
+    "<b>Always Play Toss In Small Limits</b>\n\n"
+    "<b>Agr ID Me 10K Hai Toh Toss 1K Se Khelo Only...👆</b>"
+)
+
+# Appended after the escaped original toss text once the toss gets deleted
+TOSS_LOSS_SUFFIX = (
+    "<b> Loss ❌</b>\n\n"
+    "<b>As I Said Toss Normal Limit Se Hi Khelna Hota Hai</b>\n\n"
+    "<b>10% Amount Hi Loss Hua Hai Overall Hum Same Limit Se Play Krte He Hai "
+    "Toh Profit Me Nikalte He Hai.</b>\n\n"
+    "<b>Baaki Session Me Cover Krte Hai...❤️</b>"
+)
+
+# ================= SQL =================
+# All tracked_msgs statements live here in one place; both the poster and
+# candidate paths read the row through the same SQL_GET_TRACKED.
+
+SQL_GET_TRACKED = """
+    SELECT poster_msg_id, candidate_id, candidate_text
+    FROM tracked_msgs WHERE channel_id=$1
+"""
+
+SQL_LOAD_TRACKED = """
+    SELECT channel_id, poster_msg_id, candidate_id, candidate_text
+    FROM tracked_msgs
+"""
+
+SQL_UPSERT_POSTER = """
+    INSERT INTO tracked_msgs(channel_id, poster_msg_id, candidate_id, candidate_text)
+    VALUES($1, $2, NULL, NULL)
+    ON CONFLICT(channel_id) DO UPDATE SET
+        poster_msg_id  = EXCLUDED.poster_msg_id,
+        candidate_id   = NULL,
+        candidate_text = NULL
+"""
+
+SQL_SET_CANDIDATE = """
+    UPDATE tracked_msgs
+    SET candidate_id=$2, candidate_text=$3
+    WHERE channel_id=$1
+"""
+
 # ================= DATABASE =================
 
 async def init_postgres(application: Application):
     global db_pool
-    db_pool = await asyncpg.create_pool(DATABASE_URL)
+    db_pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=PG_MIN_SIZE,
+        max_size=PG_MAX_SIZE,
+        max_inactive_connection_lifetime=300,
+        command_timeout=30,
+        statement_cache_size=0 if PGBOUNCER else 100,
+        # tracked_msgs is rebuildable bookkeeping: don't make every channel
+        # post wait on a WAL fsync. A server crash can lose at most the last
+        # few hundred ms of writes; it can never corrupt the table.
+        # JIT compilation only costs latency on single-row lookups like ours.
+        # PgBouncer rejects unknown startup parameters and wouldn't keep
+        # session settings anyway, so behind it set these on the role instead:
+        #   ALTER ROLE <bot_user> SET synchronous_commit = off;
+        #   ALTER ROLE <bot_user> SET jit = off;
+        server_settings=None if PGBOUNCER else {"synchronous_commit": "off", "jit": "off"},
+    )
 
     async with db_pool.acquire() as conn:
-        # Create table if it doesn't exist at all
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS tracked_msgs (
-                channel_id       BIGINT PRIMARY KEY,
-                poster_msg_id    BIGINT,
-                candidate_id     BIGINT,
-                candidate_text   TEXT
-            );
-        """)
-
-        # Auto-migration: add missing columns if table existed with old schema
-        for column, definition in [
-            ("poster_msg_id",  "BIGINT"),
-            ("candidate_id",   "BIGINT"),
-            ("candidate_text", "TEXT"),
-        ]:
-            exists = await conn.fetchval("""
-                SELECT COUNT(*) FROM information_schema.columns
-                WHERE table_name='tracked_msgs' AND column_name=$1
-            """, column)
-            if not exists:
-                await conn.execute(
-                    f"ALTER TABLE tracked_msgs ADD COLUMN {column} {definition};"
-                )
-                logger.info("Migration: added column '%s' to tracked_msgs", column)
-
-        # Old schema had msg_id — migrate its data into poster_msg_id then drop it
-        old_col_exists = await conn.fetchval("""
-            SELECT COUNT(*) FROM information_schema.columns
-            WHERE table_name='tracked_msgs' AND column_name='msg_id'
-        """)
-        if old_col_exists:
+        # Schema setup and migrations are all-or-nothing: a failure half way
+        # must not leave msg_id copied but not dropped, or columns half added.
+        async with conn.transaction():
+            # Create table if it doesn't exist at all.
+            # Every query filters on channel_id, which the PRIMARY KEY already
+            # indexes — keep it as the PK in future migrations, no extra index needed.
             await conn.execute("""
-                UPDATE tracked_msgs SET poster_msg_id = msg_id WHERE poster_msg_id IS NULL;
+                CREATE TABLE IF NOT EXISTS tracked_msgs (
+                    channel_id       BIGINT PRIMARY KEY,
+                    poster_msg_id    BIGINT,
+                    candidate_id     BIGINT,
+                    candidate_text   TEXT
+                );
             """)
-            await conn.execute("ALTER TABLE tracked_msgs DROP COLUMN msg_id;")
-            logger.info("Migration: moved msg_id -> poster_msg_id and dropped old column")
 
-        # Drop channel_state table if it exists from old versions
-        await conn.execute("DROP TABLE IF EXISTS channel_state;")
+            # Read the current column set once instead of probing column by column
+            existing = {
+                r["column_name"] for r in await conn.fetch("""
+                    SELECT column_name FROM information_schema.columns
+                    WHERE table_name='tracked_msgs'
+                """)
+            }
+
+            # Auto-migration: add missing columns if table existed with old schema.
+            # All of them go into one ALTER TABLE so it's a single round trip.
+            missing = [
+                (column, definition) for column, definition in [
+                    ("poster_msg_id",  "BIGINT"),
+                    ("candidate_id",   "BIGINT"),
+                    ("candidate_text", "TEXT"),
+                ]
+                if column not in existing
+            ]
+            if missing:
+                await conn.execute(
+                    "ALTER TABLE tracked_msgs "
+                    + ", ".join(f"ADD COLUMN {column} {definition}" for column, definition in missing)
+                    + ";"
+                )
+                for column, _ in missing:
+                    logger.info("Migration: added column '%s' to tracked_msgs", column)
+
+            # Old schema had msg_id — migrate its data into poster_msg_id then drop it
+            if "msg_id" in existing:
+                await conn.execute("""
+                    UPDATE tracked_msgs SET poster_msg_id = msg_id WHERE poster_msg_id IS NULL;
+                    ALTER TABLE tracked_msgs DROP COLUMN msg_id;
+                """)
+                logger.info("Migration: moved msg_id -> poster_msg_id and dropped old column")
+
+            # Drop channel_state table if it exists from old versions
+            await conn.execute("DROP TABLE IF EXISTS channel_state;")
+
+        # Warm the cache in one round trip instead of one SELECT per channel
+        rows = await conn.fetch(SQL_LOAD_TRACKED)
+        for row in rows:
+            tracked_cache[row["channel_id"]] = tracked_from_row(row)
+        logger.info("Loaded %d tracked channel(s) into cache.", len(rows))
 
     logger.info("PostgreSQL connected and tables ready.")
 
+async def get_tracked(channel_id: int) -> TrackedMsgs | None:
+    """
+    Return the tracked row for a channel, hitting the DB only on first sight.
+    """
+    if channel_id not in tracked_cache:
+        row = await db_pool.fetchrow(SQL_GET_TRACKED, channel_id)
+        tracked_cache[channel_id] = tracked_from_row(row) if row else None
+    return tracked_cache[channel_id]
+
 # ================= HELPERS =================
 
 def is_poster(message) -> bool:
@@ -115,7 +238,7 @@ def is_spam_text(text: str) -> bool:
     """
     if not text:
         return False
-    if text in ("[APK_FILE]", "[AUDIO_SPAM]"):
+    if text in SPAM_MARKERS:
         return True
     return bool(BLACKLIST_REGEX.search(text))
 
@@ -144,36 +267,35 @@ def contains_link(message) -> bool:
     if entities and any(ent.type in ['url', 'text_link'] for ent in entities):
         return True
     text = message.text or message.caption or ""
-    if "http://" in text.lower() or "https://" in text.lower() or "t.me" in text.lower():
-        return True
-    return False
+    return bool(LINK_REGEX.search(text))
 
 # ================= TOSS FINISH =================
 
-async def trigger_toss_finish(context, channel_id, reply_id, original_text):
+async def delete_toss_reply(context, channel_id, reply_id):
     try:
         await context.bot.delete_message(chat_id=channel_id, message_id=reply_id)
-    except Exception as e:
+    except TelegramError as e:
         logger.warning("Could not delete toss reply (msg_id=%s): %s", reply_id, e)
 
-    safe_text = escape(original_text)
-    final_message = (
-        f"<b>{safe_text}</b>"
-        "<b> Loss ❌</b>\n\n"
-        "<b>As I Said Toss Normal Limit Se Hi Khelna Hota Hai</b>\n\n"
-        "<b>10% Amount Hi Loss Hua Hai Overall Hum Same Limit Se Play Krte He Hai "
-        "Toh Profit Me Nikalte He Hai.</b>\n\n"
-        "<b>Baaki Session Me Cover Krte Hai...❤️</b>"
-    )
+async def send_toss_loss(context, channel_id, original_text):
+    final_message = f"<b>{escape(original_text)}</b>{TOSS_LOSS_SUFFIX}"
     try:
         await context.bot.send_message(
             chat_id=channel_id,
             text=final_message,
             parse_mode=ParseMode.HTML
         )
-    except Exception as e:
+    except TelegramError as e:
         logger.error("Failed to send toss finish message: %s", e)
 
+async def trigger_toss_finish(context, channel_id, reply_id, original_text):
+    # Removing our reminder and posting the loss message don't depend on
+    # each other, so both requests go out together.
+    await asyncio.gather(
+        delete_toss_reply(context, channel_id, reply_id),
+        send_toss_loss(context, channel_id, original_text),
+    )
+
 # ================= TOSS DELETION CHECK =================
 
 async def check_single_toss(context: ContextTypes.DEFAULT_TYPE):
@@ -192,18 +314,34 @@ async def check_single_toss(context: ContextTypes.DEFAULT_TYPE):
         await context.bot.delete_message(chat_id=LOG_CHAT_ID, message_id=temp.message_id)
         logger.info("Toss message still exists (channel=%s, msg=%s)", channel_id, original_id)
 
+    except RetryAfter as e:
+        # Try again later as a fresh job rather than sleeping in the limiter
+        logger.warning("Flood control on toss check, retrying in %ss (channel=%s)", e.retry_after, channel_id)
+        context.job_queue.run_once(check_single_toss, when=e.retry_after, data=data)
+
     except BadRequest as e:
         error_text = str(e).lower()
         if any(x in error_text for x in ["not found", "message_id_invalid", "message to copy not found"]):
             logger.info("Toss deleted — sending loss message (channel=%s)", channel_id)
             await trigger_toss_finish(context, channel_id, reply_id, original_text)
 
-    except Exception as e:
-        logger.error("Unexpected error in check_single_toss: %s", e)
+    except TelegramError as e:
+        logger.error("Telegram error in check_single_toss: %s", e)
 
-# ================= MAIN HANDLER =================
+# ================= TOSS HANDLER =================
 
-async def handle_channel_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
+class TossFilter(filters.MessageFilter):
+    """
+    Matches "toss winner" posts without a link, so PTB routes them straight
+    to handle_toss_post and the moderation handler never sees them.
+    """
+
+    def filter(self, message) -> bool:
+        text = message.text or message.caption or ""
+        return bool(TOSS_REGEX.search(text)) and not contains_link(message)
+
+
+async def handle_toss_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.channel_post
     if not message:
         return
@@ -212,129 +350,156 @@ async def handle_channel_post(update: Update, context: ContextTypes.DEFAULT_TYPE
     msg_id = message.message_id
     text = message.text or message.caption or ""
 
-    # ---------- TOSS CHECK ----------
-    if TOSS_REGEX.search(text) and not contains_link(message):
-        reply_text = (
-            "<b>Always Play Toss In Small Limits</b>\n\n"
-            "<b>Agr ID Me 10K Hai Toh Toss 1K Se Khelo Only...👆</b>"
+    try:
+        reply_msg = await message.reply_text(TOSS_REPLY_TEXT, parse_mode=ParseMode.HTML)
+        context.job_queue.run_once(
+            check_single_toss,
+            when=20,
+            data={
+                "channel_id": channel_id,
+                "original_id": msg_id,
+                "reply_id": reply_msg.message_id,
+                "original_text": text
+            }
         )
-        try:
-            reply_msg = await message.reply_text(reply_text, parse_mode=ParseMode.HTML)
-            context.job_queue.run_once(
-                check_single_toss,
-                when=20,
-                data={
-                    "channel_id": channel_id,
-                    "original_id": msg_id,
-                    "reply_id": reply_msg.message_id,
-                    "original_text": text
-                }
-            )
-        except Exception as e:
-            logger.error("Failed to handle toss message: %s", e)
+    except TelegramError as e:
+        logger.error("Failed to handle toss message: %s", e)
+
+# ================= MAIN HANDLER =================
+
+async def handle_channel_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.channel_post
+    if not message:
         return
 
+    channel_id = message.chat_id
+    msg_id = message.message_id
+
     # ---------- MODERATION ----------
     if not db_pool:
         logger.error("Database pool not initialized.")
         return
 
     msg_is_poster = is_poster(message)
+    row = await get_tracked(channel_id)
+
+    # A non-poster only matters if it is the immediate next message after a
+    # tracked poster and no candidate is stored yet. Everything else (the vast
+    # majority of posts) returns here without touching the pool.
+    if not msg_is_poster and not (
+        row
+        and row.poster_msg_id
+        and msg_id == row.poster_msg_id + 1
+        and not row.candidate_id
+    ):
+        return
 
-    async with db_pool.acquire() as conn:
+    if msg_is_poster:
+        if row:
+            old_poster_id = row.poster_msg_id
+            candidate_id  = row.candidate_id
+            candidate_text = row.candidate_text
 
-        if msg_is_poster:
-            row = await conn.fetchrow(
-                "SELECT poster_msg_id, candidate_id, candidate_text FROM tracked_msgs WHERE channel_id=$1",
-                channel_id
-            )
+            to_delete = []
+
+            # ── Step 1: Delete spam from OLD poster's window ──
+            # This is the ONLY place spam gets deleted.
+            # candidate was stored when a message arrived at old_poster_id+1.
+            # We check it NOW (on new poster arrival), NOT when it originally arrived.
+            # So the new poster's next message is NEVER touched.
+            if (
+                candidate_id
+                and old_poster_id
+                and candidate_id == old_poster_id + 1
+                and is_spam_text(candidate_text)
+            ):
+                to_delete.append(candidate_id)
 
-            if row:
-                old_poster_id = row["poster_msg_id"]
-                candidate_id  = row["candidate_id"]
-                candidate_text = row["candidate_text"]
-
-                # ── Step 1: Delete spam from OLD poster's window ──
-                # This is the ONLY place spam gets deleted.
-                # candidate was stored when a message arrived at old_poster_id+1.
-                # We check it NOW (on new poster arrival), NOT when it originally arrived.
-                # So the new poster's next message is NEVER touched.
-                if (
-                    candidate_id
-                    and old_poster_id
-                    and candidate_id == old_poster_id + 1
-                    and is_spam_text(candidate_text)
-                ):
-                    try:
-                        await context.bot.delete_message(
-                            chat_id=channel_id,
-                            message_id=candidate_id
-                        )
-                        logger.info("Deleted spam (channel=%s, msg=%s)", channel_id, candidate_id)
-                    except BadRequest as e:
-                        logger.warning("Spam already gone (msg=%s): %s", candidate_id, e)
-                    except Exception as e:
-                        logger.error("Could not delete spam (msg=%s): %s", candidate_id, e)
-
-                # ── Step 2: Delete the OLD poster ──
+            # ── Step 2: Delete the OLD poster ──
+            if old_poster_id:
+                to_delete.append(old_poster_id)
+
+            # One deleteMessages request covers both; ids that are already
+            # gone are skipped by Telegram instead of failing the call. The
+            # spam and old-poster deletes now succeed or fail together.
+            if to_delete:
                 try:
-                    await context.bot.delete_message(
+                    await context.bot.delete_messages(
                         chat_id=channel_id,
-                        message_id=old_poster_id
+                        message_ids=to_delete
                     )
-                    logger.info("Deleted old poster (channel=%s, msg=%s)", channel_id, old_poster_id)
-                except BadRequest as e:
-                    logger.warning("Old poster already gone (msg=%s): %s", old_poster_id, e)
-                except Exception as e:
-                    logger.error("Could not delete old poster (msg=%s): %s", old_poster_id, e)
-
-            # ── Step 3: Store new poster, clear candidate window ──
-            await conn.execute("""
-                INSERT INTO tracked_msgs(channel_id, poster_msg_id, candidate_id, candidate_text)
-                VALUES($1, $2, NULL, NULL)
-                ON CONFLICT(channel_id) DO UPDATE SET
-                    poster_msg_id  = EXCLUDED.poster_msg_id,
-                    candidate_id   = NULL,
-                    candidate_text = NULL
-            """, channel_id, msg_id)
-
-            logger.info("New poster tracked (channel=%s, msg=%s)", channel_id, msg_id)
-
-        else:
-            # ── Store as spam candidate if it's the immediate next message after poster ──
-            # We NEVER delete here. Only record. Decision is made when next poster arrives.
-            row = await conn.fetchrow(
-                "SELECT poster_msg_id, candidate_id FROM tracked_msgs WHERE channel_id=$1",
-                channel_id
-            )
-
-            if (
-                row
-                and row["poster_msg_id"]
-                and msg_id == row["poster_msg_id"] + 1
-                and not row["candidate_id"]
-            ):
-                candidate_text = extract_candidate_text(message)
-                if candidate_text:
-                    await conn.execute("""
-                        UPDATE tracked_msgs
-                        SET candidate_id=$2, candidate_text=$3
-                        WHERE channel_id=$1
-                    """, channel_id, msg_id, candidate_text)
+                    # Telegram skips ids that were already removed, so this
+                    # confirms the request, not that every id still existed.
                     logger.info(
-                        "Stored spam candidate (channel=%s, msg=%s)",
-                        channel_id, msg_id
+                        "Deleted old poster window (channel=%s, msgs=%s)",
+                        channel_id, to_delete
                     )
+                except TelegramError as e:
+                    logger.error("Could not delete old poster window (msgs=%s): %s", to_delete, e)
+
+        # ── Step 3: Store new poster, clear candidate window ──
+        await db_pool.execute(SQL_UPSERT_POSTER, channel_id, msg_id)
+        if row:
+            row.poster_msg_id = msg_id
+            row.candidate_id = None
+            row.candidate_text = None
+        else:
+            tracked_cache[channel_id] = TrackedMsgs(poster_msg_id=msg_id)
+
+        logger.info("New poster tracked (channel=%s, msg=%s)", channel_id, msg_id)
+
+    else:
+        # ── Store as spam candidate if it's the immediate next message after poster ──
+        # We NEVER delete here. Only record. Decision is made when next poster arrives.
+        candidate_text = extract_candidate_text(message)
+        if candidate_text:
+            await db_pool.execute(SQL_SET_CANDIDATE, channel_id, msg_id, candidate_text)
+            row.candidate_id = msg_id
+            row.candidate_text = candidate_text
+            logger.info(
+                "Stored spam candidate (channel=%s, msg=%s)",
+                channel_id, msg_id
+            )
 
 # ================= ENTRY POINT =================
 
 def main():
+    # uvloop is a faster drop-in event loop; fall back to asyncio where it
+    # isn't installed (e.g. Windows).
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
     application = (
         Application.builder()
         .token(BOT_TOKEN)
         .post_init(init_postgres)
+        # Token-bucket throttle on every Bot API call; bursts are queued
+        # instead of tripping Telegram's global ~30 req/s flood limit.
+        # The per-group bucket is off: AIORateLimiter would put every
+        # channel and LOG_CHAT_ID under the 20 msg/min group *send* limit,
+        # which would also hold back deletes and the toss copy/delete probe.
+        # No retries (max_retries=0): a retrying request makes the limiter
+        # pause *every* request until retry_after passes, which would stall
+        # moderation in all channels. RetryAfter is raised to the caller
+        # instead; check_single_toss reschedules itself on it.
+        .rate_limiter(AIORateLimiter(group_max_rate=0, max_retries=0))
         .build()
     )
+    # Order matters: only the first matching handler in a group runs.
+    # The toss handler touches no tracked_msgs state, so it runs as a
+    # background task (block=False) and doesn't hold up moderation of the
+    # posts behind it; moderation itself stays strictly in order. This relies
+    # on the rate limiter never retrying (max_retries=0): a retry would pause
+    # all Bot API calls, moderation included.
+    application.add_handler(
+        MessageHandler(
+            filters.ChatType.CHANNEL & TossFilter(), handle_toss_post, block=False
+        )
+    )
     application.add_handler(
         MessageHandler(filters.ChatType.CHANNEL, handle_channel_post)
     )